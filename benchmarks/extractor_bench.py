@@ -0,0 +1,69 @@
+# Per-call yt-dlp overhead: a fresh YoutubeDL per lookup (the old code path) vs ExtractorPool
+# Usage: python benchmarks/extractor_bench.py [calls] [--online "search query"]
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import yt_dlp  # noqa: E402
+
+from bot import ExtractorPool, flat_ydl_opts, ydl_opts  # noqa: E402
+
+
+def per_call_ms(fn, calls):
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    for _ in range(calls):
+        fn()
+    return (time.perf_counter() - start_wall) * 1000 / calls, (time.process_time() - start_cpu) * 1000 / calls
+
+
+def fresh(options, work=None):
+    def call():
+        with yt_dlp.YoutubeDL(options) as ydl:
+            if work:
+                work(ydl)
+    return call
+
+
+def pooled(pool, work=None):
+    def call():
+        with pool.acquire() as ydl:
+            if work:
+                work(ydl)
+    return call
+
+
+def report(label, before, after):
+    print(f"{label:<28}{before[0]:>9.2f} ms{before[1]:>9.2f} ms{after[0]:>9.2f} ms{after[1]:>9.2f} ms")
+
+
+def main():
+    args = sys.argv[1:]
+    query = None
+    if '--online' in args:
+        idx = args.index('--online')
+        query = args[idx + 1]
+        del args[idx:idx + 2]
+    calls = int(args[0]) if args else 50
+
+    print(f"{calls} calls each{'':<13}{'fresh wall':>12}{'fresh cpu':>12}{'pool wall':>12}{'pool cpu':>12}")
+    for label, options in (("setup only (full opts)", ydl_opts), ("setup only (flat opts)", flat_ydl_opts)):
+        pool = ExtractorPool(options, 1)
+        pool.warm()
+        report(label, per_call_ms(fresh(options), calls), per_call_ms(pooled(pool), calls))
+
+    if query:
+        # Real network lookups; keep the call count low to stay polite to YouTube
+        def search(ydl):
+            ydl.extract_info(f"ytsearch1:{query}", download=False)
+
+        pool = ExtractorPool(flat_ydl_opts, 1)
+        pool.warm()
+        online_calls = min(calls, 5)
+        report(f"ytsearch1 x{online_calls}", per_call_ms(fresh(flat_ydl_opts, search), online_calls),
+               per_call_ms(pooled(pool, search), online_calls))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,412 @@
+# Offline load test: drives !play, !skip and chat traffic from thousands of fake guilds through bot.py
+# yt_dlp and spotipy are replaced by stubs with configurable latency and Discord by in-memory fakes,
+# so no network, token or voice connection is needed.
+# Usage: python benchmarks/load_test.py [--guilds 2000] [--actions 6] [--youtube-latency 0.15] [--ffmpeg] ... 2>/dev/null
+import argparse
+import asyncio
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+parser = argparse.ArgumentParser(description="Offline load test for bot.py")
+parser.add_argument('--guilds', type=int, default=2000, help="simulated guilds, each with one listener")
+parser.add_argument('--actions', type=int, default=6, help="messages each guild sends")
+parser.add_argument('--think', type=float, default=0.5, help="max seconds between a guild's messages")
+parser.add_argument('--songs', type=int, default=500, help="distinct songs; requests are skewed towards the popular ones")
+parser.add_argument('--skip-ratio', type=float, default=0.2)
+parser.add_argument('--chat-ratio', type=float, default=0.3, help="share of plain chat messages (autoresponder path)")
+parser.add_argument('--spotify-ratio', type=float, default=0.1, help="share of !play requests that are Spotify links")
+parser.add_argument('--youtube-latency', type=float, default=0.15, help="mean seconds per yt-dlp call")
+parser.add_argument('--spotify-latency', type=float, default=0.08, help="mean seconds per Spotify call")
+parser.add_argument('--jitter', type=float, default=0.5, help="latency varies by +/- this fraction")
+parser.add_argument('--play-time', type=float, default=2.0, help="seconds a simulated track plays for")
+parser.add_argument('--ffmpeg', action='store_true', help="play a generated local file through real ffmpeg")
+parser.add_argument('--no-tracemalloc', action='store_true', help="skip allocation tracking (it slows everything down)")
+parser.add_argument('--seed', type=int, default=0)
+args = parser.parse_args()
+
+upstream_calls = {'youtube': 0, 'spotify': 0}
+_calls_lock = threading.Lock()
+
+
+def upstream(kind, latency):
+    """Blocks like a network call would; runs on the bot's resolver threads."""
+    with _calls_lock:
+        upstream_calls[kind] += 1
+    time.sleep(max(0.0, latency * (1 + random.uniform(-args.jitter, args.jitter))))
+
+
+def song_id(name):
+    return f"{abs(hash(name)) % 10 ** 11:011d}"
+
+
+def song_duration(video_id):
+    return 120 + int(video_id) % 180
+
+
+# Stub yt_dlp: search, video and playlist extraction with the fields bot.py reads
+class StubYoutubeDL:
+    def __init__(self, params=None):
+        self.params = params or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def extract_info(self, url, download=False):
+        upstream('youtube', args.youtube_latency)
+        if url.startswith('ytsearch'):
+            query = url.split(':', 1)[1]
+            video_id = song_id(query)
+            return {'entries': [{'id': video_id, 'title': query, 'duration': song_duration(video_id)}]}
+        if 'list=' in url:
+            entries = [song_id(f"{url} {i}") for i in range(50)]
+            return {'title': 'Stub playlist', 'entries': [{'id': v, 'title': v, 'duration': song_duration(v)} for v in entries]}
+        video_id = url[-11:]
+        return {
+            'id': video_id,
+            'title': f"Song {video_id}",
+            'duration': song_duration(video_id),
+            'thumbnail': f"https://i.ytimg.com/vi/{video_id}/hqdefault.jpg",
+            'url': stream_url(video_id),
+        }
+
+
+# Stub spotipy: single tracks plus the collection calls used by imports
+class StubSpotify:
+    def __init__(self, *a, **k):
+        pass
+
+    def track(self, track_id):
+        upstream('spotify', args.spotify_latency)
+        return {'name': f"Spotify {track_id}", 'artists': [{'name': 'Stub Artist'}], 'album': {'images': []}}
+
+    def album(self, album_id):
+        upstream('spotify', args.spotify_latency)
+        return {'name': 'Stub album', 'tracks': {'items': [self._item(album_id, i) for i in range(20)], 'next': None}}
+
+    def playlist_items(self, playlist_id, **kwargs):
+        upstream('spotify', args.spotify_latency)
+        return {'items': [{'track': self._item(playlist_id, i)} for i in range(50)], 'next': None}
+
+    def artist_top_tracks(self, artist_id):
+        upstream('spotify', args.spotify_latency)
+        return {'tracks': [self._item(artist_id, i) for i in range(10)]}
+
+    def next(self, page):
+        return None
+
+    @staticmethod
+    def _item(collection_id, i):
+        return {'id': f"{collection_id}{i}", 'name': f"Track {i}", 'artists': [{'name': 'Stub Artist'}], 'album': {'images': []}}
+
+
+stub_yt_dlp = types.ModuleType('yt_dlp')
+stub_yt_dlp.YoutubeDL = StubYoutubeDL
+stub_spotipy = types.ModuleType('spotipy')
+stub_spotipy.Spotify = StubSpotify
+stub_oauth2 = types.ModuleType('spotipy.oauth2')
+stub_oauth2.SpotifyClientCredentials = lambda *a, **k: None
+stub_spotipy.oauth2 = stub_oauth2
+sys.modules.update({'yt_dlp': stub_yt_dlp, 'spotipy': stub_spotipy, 'spotipy.oauth2': stub_oauth2})
+
+# Keep the log, caches and queue state of the run out of the working tree
+workdir = tempfile.mkdtemp(prefix='load_test_')
+os.chdir(workdir)
+os.environ.update({
+    'AUDIO_CACHE_MIN_PLAYS': '0',
+    'QUEUE_STATE_PATH': '',
+    'METRICS_PORT': '0',
+    'SPOTIFY_CLIENT_ID': 'stub',
+    'SPOTIFY_CLIENT_SECRET': 'stub',
+})
+
+test_file = None
+if args.ffmpeg:
+    if shutil.which('ffmpeg') is None:
+        sys.exit("--ffmpeg needs ffmpeg on PATH")
+    test_file = os.path.join(workdir, 'test.webm')
+    subprocess.run(
+        ['ffmpeg', '-loglevel', 'error', '-f', 'lavfi', '-i', f"sine=frequency=440:duration={args.play_time}",
+         '-c:a', 'libopus', '-b:a', '128k', test_file],
+        check=True
+    )
+
+
+def stream_url(video_id):
+    if test_file:
+        return test_file
+    return f"https://stub.invalid/videoplayback?expire={int(time.time()) + 21600}&id={video_id}&mime=audio%2Fwebm"
+
+
+import discord  # noqa: E402
+from discord.ext import commands  # noqa: E402
+
+import bot  # noqa: E402
+
+
+# Fake Discord objects, just enough surface for bot.py and discord.ext.commands
+class FakeMessage:
+    _ids = 0
+
+    def __init__(self, content='', author=None, channel=None):
+        FakeMessage._ids += 1
+        self.id = FakeMessage._ids
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild if channel else None
+        self.attachments = []
+        self._state = None
+
+    async def edit(self, **kwargs):
+        stats['edits'] += 1
+
+
+class FakeTextChannel:
+    def __init__(self, channel_id, guild):
+        self.id = channel_id
+        self.guild = guild
+        self.name = f"text-{channel_id}"
+
+    async def send(self, content=None, **kwargs):
+        stats['sends'] += 1
+        return FakeMessage(content or '', channel=self)
+
+    def get_partial_message(self, message_id):
+        return FakeMessage(channel=self)
+
+
+class FakeVoiceChannel:
+    def __init__(self, channel_id, guild):
+        self.id = channel_id
+        self.guild = guild
+        self.name = f"voice-{channel_id}"
+        self.members = []
+
+    async def connect(self, **kwargs):
+        self.guild.voice_client = FakeVoiceClient(self)
+        return self.guild.voice_client
+
+
+class FakeVoiceClient:
+    """Plays a source for --play-time seconds, or drains real ffmpeg output on a thread with --ffmpeg."""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.source = None
+        self._connected = True
+        self._playing = None  # Token of the current playback
+        self._paused = False
+        self._after = None
+
+    def is_connected(self):
+        return self._connected
+
+    def is_playing(self):
+        return self._playing is not None and not self._paused
+
+    def is_paused(self):
+        return self._playing is not None and self._paused
+
+    def play(self, source, after=None):
+        if self._playing is not None:
+            raise discord.ClientException('Already playing audio.')
+        token = self._playing = object()
+        self.source, self._after = source, after
+        loop = asyncio.get_running_loop()
+        if args.ffmpeg:
+            threading.Thread(target=self._drain, args=(token, loop), daemon=True).start()
+        else:
+            source.read()  # First frame, as discord.py would read it
+            loop.call_later(args.play_time, self._finish, token)
+
+    def _drain(self, token, loop):
+        try:
+            while self._playing is token and self.source.read():
+                pass
+        except (OSError, ValueError):
+            pass  # Stopped: the source was cleaned up under us
+        loop.call_soon_threadsafe(self._finish, token)
+
+    def _finish(self, token):
+        if self._playing is not token:
+            return  # Stopped or replaced first
+        # Track time is compressed, so a natural end reports the whole track as sent
+        self.source.frames = 10 ** 7
+        self._end()
+
+    def _end(self):
+        self._playing = None
+        self.source.cleanup()
+        if self._after:
+            self._after(None)
+
+    def stop(self):
+        if self._playing is not None:
+            self._end()
+
+    def pause(self):
+        self._paused = True
+
+    def resume(self):
+        self._paused = False
+
+    async def disconnect(self, force=False):
+        self._connected = False
+        self.stop()
+        self.channel.guild.voice_client = None
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.name = f"guild-{guild_id}"
+        self.voice_client = None
+        self.text = FakeTextChannel(guild_id * 10 + 1, self)
+        self.voice = FakeVoiceChannel(guild_id * 10 + 2, self)
+        self.member = types.SimpleNamespace(
+            id=guild_id * 10 + 3, name=f"user-{guild_id}", bot=False, mention=f"<@{guild_id * 10 + 3}>",
+            voice=types.SimpleNamespace(channel=self.voice)
+        )
+        self.voice.members.append(self.member)
+
+
+stats = {'sends': 0, 'edits': 0, 'errors': 0}
+latencies = {'play': [], 'skip': [], 'chat': []}
+loop_lag = []
+guilds = {}
+channels = {}
+
+
+async def context_send(self, content=None, **kwargs):
+    return await self.channel.send(content, **kwargs)
+
+
+async def count_command_error(ctx, error):
+    stats['errors'] += 1
+    if stats['errors'] <= 3:
+        print(f"command error in {ctx.command}: {error!r}", file=sys.stderr)
+
+
+def install_fakes():
+    commands.Context.send = context_send
+    bot.bot.get_guild = guilds.get
+    bot.bot.get_channel = channels.get
+    bot.bot._connection.user = types.SimpleNamespace(id=0, bot=True, name='bot')
+    bot.bot.add_listener(count_command_error, 'on_command_error')
+    if not args.ffmpeg:
+        async def create_source(self, song):
+            return bot.TrackedSource(FakeSource(), 'stub', None)
+
+        bot.MusicPlayer.create_source = create_source
+
+
+class FakeSource(discord.AudioSource):
+    def read(self):
+        return b'\xf8\xff\xfe'  # Opus silence frame
+
+    def is_opus(self):
+        return True
+
+
+def pick_song(rng):
+    # Pareto-skewed popularity: a few songs are requested by many guilds, like real charts
+    return f"stub song {min(int(rng.paretovariate(1.2)) - 1, args.songs - 1)}"
+
+
+async def run_guild(guild, rng):
+    for _ in range(args.actions):
+        await asyncio.sleep(rng.uniform(0, args.think))
+        roll = rng.random()
+        if roll < args.chat_ratio:
+            kind, content = 'chat', rng.choice(("good morning", "who is playing this", "ba7a", "lol", "aoko"))
+        elif roll < args.chat_ratio + args.skip_ratio:
+            kind, content = 'skip', '!skip'
+        elif rng.random() < args.spotify_ratio:
+            kind, content = 'play', f"!play https://open.spotify.com/track/{song_id(pick_song(rng))}"
+        else:
+            kind, content = 'play', f"!play {pick_song(rng)}"
+        message = FakeMessage(content, guild.member, guild.text)
+        start = time.perf_counter()
+        await bot.on_message(message)
+        latencies[kind].append(time.perf_counter() - start)
+
+
+async def watch_lag(interval=0.1):
+    while True:
+        expected = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+        loop_lag.append(max(0.0, time.perf_counter() - expected))
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def main():
+    rng = random.Random(args.seed)
+    random.seed(args.seed)
+    for guild_id in range(1, args.guilds + 1):
+        guild = guilds[guild_id] = FakeGuild(guild_id)
+        channels[guild.text.id] = guild.text
+        channels[guild.voice.id] = guild.voice
+    install_fakes()
+    lag_task = asyncio.create_task(watch_lag())
+
+    if not args.no_tracemalloc:
+        tracemalloc.start()
+    start = time.perf_counter()
+    await asyncio.gather(*(run_guild(guild, random.Random(rng.random())) for guild in guilds.values()))
+    elapsed = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else None
+    tracemalloc.stop()
+    lag_task.cancel()
+
+    live_players = len(bot.players)
+    queued = sum(len(player.queue) for player in bot.players.players.values())
+    for player in list(bot.players.players.values()):
+        await player.close()
+
+    messages = sum(len(v) for v in latencies.values())
+    print(f"{args.guilds} guilds x {args.actions} messages in {elapsed:.2f}s: {messages / elapsed:.0f} messages/s")
+    print(f"{'':<8}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for kind, values in latencies.items():
+        print(f"{kind:<8}{len(values):>8}{percentile(values, 50) * 1000:>10.2f}"
+              f"{percentile(values, 99) * 1000:>10.2f}{max(values, default=0) * 1000:>10.2f}")
+    print(f"event loop lag: p99 {percentile(loop_lag, 99) * 1000:.1f} ms, max {max(loop_lag, default=0) * 1000:.1f} ms")
+    print(f"upstream calls: youtube {upstream_calls['youtube']}, spotify {upstream_calls['spotify']}"
+          f" (shared in flight: {bot.resolver.shared})")
+    q, s = bot.query_cache.stats(), bot.stream_cache.stats()
+    print(f"query cache hit rate {q['hit_rate']:.0%}, stream cache hit rate {s['hit_rate']:.0%}")
+    print(f"players {live_players}, queued tracks {queued}, discord sends {stats['sends']}, edits {stats['edits']},"
+          f" command errors {stats['errors']}")
+    if memory:
+        print(f"tracemalloc: {memory[0] / 2 ** 20:.1f} MB current, {memory[1] / 2 ** 20:.1f} MB peak")
+    print(f"max RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,94 @@
+# Micro-benchmark: the old list-of-dicts queue vs TrackQueue + Track at 10k entries
+# Usage: python benchmarks/queue_bench.py [entries]
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot import Track, TrackQueue  # noqa: E402
+
+
+def make_dict(i):
+    # Shape of the queue entries before Track existed
+    return {
+        'title': f"Song number {i}",
+        'url': f"https://rr1---sn-example.googlevideo.com/videoplayback?expire=1700000000&id={i:011d}&itag=251",
+        'duration': 180 + i % 120,
+        'thumbnail': f"https://i.ytimg.com/vi/{i:011d}/hqdefault.jpg",
+        'source': 'youtube',
+        'video_id': f"{i:011d}",
+        'added_by': 'someone',
+    }
+
+
+def make_track(i):
+    return Track(
+        f"Song number {i}",
+        f"{i:011d}",
+        180 + i % 120,
+        f"https://i.ytimg.com/vi/{i:011d}/hqdefault.jpg",
+        'youtube',
+        'someone',
+        f"https://rr1---sn-example.googlevideo.com/videoplayback?expire=1700000000&id={i:011d}&itag=251",
+    )
+
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return (time.perf_counter() - start) * 1000
+
+
+def measure_memory(build):
+    tracemalloc.start()
+    kept = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return size / 1024
+
+
+def bench_list(n, deletes):
+    queue = []
+    results = {'enqueue': timed(lambda: [queue.append(make_dict(i)) for i in range(n)])}
+    results['delete'] = timed(lambda: [queue.pop(random.randrange(len(queue))) for _ in range(deletes)])
+    results['move'] = timed(lambda: [queue.insert(random.randrange(len(queue)), queue.pop(random.randrange(len(queue)))) for _ in range(deletes)])
+    results['shuffle'] = timed(lambda: random.shuffle(queue))
+    results['dequeue'] = timed(lambda: [queue.pop(0) for _ in range(len(queue))])
+    results['memory_kb'] = measure_memory(lambda: [make_dict(i) for i in range(n)])
+    return results
+
+
+def bench_track_queue(n, deletes):
+    queue = TrackQueue()
+    results = {'enqueue': timed(lambda: [queue.put_nowait(make_track(i)) for i in range(n)])}
+    results['delete'] = timed(lambda: [queue.remove_at(random.randrange(len(queue))) for _ in range(deletes)])
+    results['move'] = timed(lambda: [queue.move(random.randrange(len(queue)), random.randrange(len(queue) - 1)) for _ in range(deletes)])
+    results['shuffle'] = timed(queue.shuffle)
+    results['dedupe'] = timed(queue.dedupe)
+    results['dequeue'] = timed(lambda: [queue.get_nowait() for _ in range(len(queue))])
+    results['memory_kb'] = measure_memory(lambda: [make_track(i) for i in range(n)])
+    return results
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    deletes = n // 10
+    random.seed(0)
+    old = bench_list(n, deletes)
+    random.seed(0)
+    new = bench_track_queue(n, deletes)
+
+    print(f"{n} entries, {deletes} random deletes/moves")
+    print(f"{'operation':<12}{'list of dicts':>16}{'TrackQueue':>14}")
+    for key in ('enqueue', 'delete', 'move', 'shuffle', 'dedupe', 'dequeue'):
+        before = f"{old[key]:.2f} ms" if key in old else '-'
+        print(f"{key:<12}{before:>16}{new[key]:>11.2f} ms")
+    print(f"{'memory':<12}{old['memory_kb']:>13.0f} KB{new['memory_kb']:>11.0f} KB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+# Runs the bot as several processes, each owning a contiguous range of shards
+# Usage: python cluster.py [--processes N] [--shards M]
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import time
+import urllib.request
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - cluster - %(levelname)s - %(message)s')
+logger = logging.getLogger('cluster')
+
+RESTART_BACKOFF_MAX = 60  # Seconds between restarts of a child that keeps crashing
+STABLE_AFTER = 300  # A child that ran this long resets its backoff
+
+
+def recommended_shards(token):
+    """Asks Discord how many shards it wants for this bot; None if that fails."""
+    request = urllib.request.Request(
+        'https://discord.com/api/v10/gateway/bot',
+        headers={'Authorization': f"Bot {token}", 'User-Agent': 'DiscordBot (cluster.py, 1.0)'}
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return json.load(response)['shards']
+    except Exception as e:
+        logger.warning(f"Could not fetch the recommended shard count: {e}")
+        return None
+
+
+def split_shards(shard_count, processes):
+    """Splits shard IDs into contiguous, near-equal ranges, one per process."""
+    size, extra = divmod(shard_count, processes)
+    ranges, start = [], 0
+    for i in range(processes):
+        end = start + size + (1 if i < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return [shards for shards in ranges if shards]
+
+
+def run_cluster(cluster_id, shard_ids, shard_count):
+    os.environ['CLUSTER_ID'] = str(cluster_id)
+    os.environ['SHARD_IDS'] = ','.join(map(str, shard_ids))
+    os.environ['SHARD_COUNT'] = str(shard_count)
+    # Resolutions are shared across the machine; the audio cache index is per process
+    os.environ.setdefault('SHARED_CACHE_PATH', 'resolution_cache.db')
+    os.environ['AUDIO_CACHE_DIR'] = os.path.join(os.getenv('AUDIO_CACHE_DIR', 'audio_cache'), f"cluster-{cluster_id}")
+    # Rotation renames the file, which only works with one writer per log
+    base, ext = os.path.splitext(os.getenv('LOG_FILE', 'music_bot.log'))
+    os.environ['LOG_FILE'] = f"{base}.cluster-{cluster_id}{ext}"
+    metrics_port = int(os.getenv('METRICS_PORT', '0'))
+    if metrics_port:
+        os.environ['METRICS_PORT'] = str(metrics_port + cluster_id)  # One endpoint per process, scrape them all
+
+    import bot
+    bot.bot.run(bot.TOKEN, log_handler=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the music bot as a multi-process shard cluster")
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help="number of bot processes")
+    parser.add_argument('--shards', type=int, help="total shard count (default: Discord's recommendation)")
+    args = parser.parse_args()
+
+    shard_count = args.shards or recommended_shards(os.getenv('TOKEN')) or args.processes
+    clusters = split_shards(shard_count, max(1, args.processes))
+    logger.info(f"Starting {len(clusters)} processes for {shard_count} shards")
+
+    context = multiprocessing.get_context('spawn')
+    children = {}  # cluster ID -> (process, started_at, backoff)
+    stopping = False
+
+    def start(cluster_id, backoff=1):
+        process = context.Process(
+            target=run_cluster, args=(cluster_id, clusters[cluster_id], shard_count), name=f"cluster-{cluster_id}"
+        )
+        process.start()
+        children[cluster_id] = (process, time.monotonic(), backoff)
+        logger.info(f"Cluster {cluster_id} (shards {clusters[cluster_id][0]}-{clusters[cluster_id][-1]}) started as pid {process.pid}")
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for process, _, _ in children.values():
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for cluster_id in range(len(clusters)):
+        start(cluster_id)
+
+    while not stopping:
+        time.sleep(1)
+        for cluster_id, (process, started_at, backoff) in list(children.items()):
+            if process.is_alive() or stopping:
+                continue
+            if time.monotonic() - started_at >= STABLE_AFTER:
+                backoff = 1
+            logger.warning(f"Cluster {cluster_id} exited with code {process.exitcode}; restarting in {backoff}s")
+            time.sleep(backoff)
+            if not stopping:
+                start(cluster_id, min(backoff * 2, RESTART_BACKOFF_MAX))
+
+    for process, _, _ in children.values():
+        process.join(timeout=30)
+        if process.is_alive():
+            process.kill()
+    logger.info("Cluster stopped")
+
+
+if __name__ == '__main__':
+    main()